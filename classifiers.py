@@ -0,0 +1,75 @@
+"""
+Local Classifiers - Small ONNX text classifiers for sentiment and risk
+"""
+
+import logging
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SENTIMENT_LABELS = ("negative", "neutral", "positive")
+RISK_LABELS = ("low", "medium", "high")
+
+
+class OnnxTextClassifier:
+    """Sequence classifier exported with ``optimum-cli export onnx`` (int8 quantized).
+
+    Input is truncated from the left so the most recent turns are always classified.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        tokenizer_path: str,
+        labels: Sequence[str],
+        max_length: int = 512,
+    ):
+        # Imported here so the runtime is only needed when a model is configured
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.labels = tuple(labels)
+        self.session = ort.InferenceSession(
+            model_path, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length, direction="left")
+
+    def classify(self, text: str) -> str:
+        encoding = self.tokenizer.encode(text)
+        feeds = {
+            "input_ids": np.array([encoding.ids], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids], dtype=np.int64),
+        }
+        logits = self.session.run(
+            None, {name: feeds[name] for name in self._input_names}
+        )[0][0]
+        return self.labels[int(np.argmax(logits))]
+
+
+def load_classifier(
+    prefix: str, default_labels: Sequence[str]
+) -> Optional[OnnxTextClassifier]:
+    """Build a classifier from ``<prefix>_ONNX_MODEL``; returns None if it is not set.
+
+    The tokenizer defaults to ``tokenizer.json`` next to the model, and labels can be
+    overridden with a comma-separated ``<prefix>_LABELS`` in the model's output order.
+    """
+    model_path = os.getenv(f"{prefix}_ONNX_MODEL")
+    if not model_path:
+        return None
+    tokenizer_path = os.getenv(
+        f"{prefix}_TOKENIZER",
+        os.path.join(os.path.dirname(model_path), "tokenizer.json"),
+    )
+    labels = os.getenv(f"{prefix}_LABELS")
+    labels = (
+        [label.strip() for label in labels.split(",")] if labels else default_labels
+    )
+    logger.info("Loading %s classifier from %s", prefix.lower(), model_path)
+    return OnnxTextClassifier(model_path, tokenizer_path, labels)
@@ -2,136 +2,739 @@
 Counselor Agent - Provides nudges to counselors during patient conversations
 """
 
+import asyncio
 import os
-import json
 import logging
-import re
-from typing import List, Dict, Optional
-from openai import OpenAI
+import random
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+import httpx
+import orjson
+import openai
+import tiktoken
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from classifiers import OnnxTextClassifier
+    from semantic_cache import SemanticCache
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Per-field instructions; each system prompt below is assembled once at import so
+# it stays byte-identical across calls and OpenAI's prefix cache can reuse it. The
+# conversation follows it as chat messages, with per-turn content at the end.
+_FIELD_INSTRUCTIONS = {
+    "problems": "PROBLEMS: List all problems or concerns the patient is expressing. Each problem should be a short, clear statement. Return as a list.",
+    "nudges": "NUDGES: Provide 3-5 actionable suggestions for the counselor. Each nudge should be one short sentence. Return as a list.",
+    "sentiment": "SENTIMENT: Identify the main emotional tone using simple words like: positive, negative, anxiety, neutral, sadness, anger, fear, hope, etc. Return as a list of 1-3 emotion words that best describe the conversation.",
+    "follow_up": "FOLLOW_UP: One short question the counselor could ask next.",
+    "risk": "RISK: The patient's current risk level: low, medium, or high.",
+}
+
+# Structured outputs guarantee the reply matches this shape, so the prompt does
+# not need to describe the JSON format.
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "problems": {"type": "array", "items": {"type": "string"}},
+        "nudges": {"type": "array", "items": {"type": "string"}},
+        "sentiment": {"type": "array", "items": {"type": "string"}},
+        "follow_up": {"type": "string"},
+        "risk": {"type": "string", "enum": ["low", "medium", "high"]},
+    },
+    "required": ["problems", "nudges", "sentiment", "follow_up", "risk"],
+    "additionalProperties": False,
+}
+
+
+def _system_prompt(fields: Tuple[str, ...]) -> str:
+    instructions = "\n\n".join(
+        f"{i}. {_FIELD_INSTRUCTIONS[field]}" for i, field in enumerate(fields, 1)
+    )
+    return (
+        "You are an expert counselor assistant.\n\n"
+        "The messages that follow are a patient-counselor conversation: user messages "
+        "are the patient and assistant messages are the counselor. When asked, "
+        "analyze the conversation and provide:\n\n"
+        f"{instructions}\n\n"
+        "Use simple, clear words. Keep everything short and direct."
+    )
+
+
+def _response_format(name: str, fields: Tuple[str, ...]) -> Dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    field: RESPONSE_SCHEMA["properties"][field] for field in fields
+                },
+                "required": list(fields),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+# The full analysis in one request, used for offline reports
+_ALL_FIELDS = tuple(RESPONSE_SCHEMA["required"])
+SYSTEM_PROMPT = _system_prompt(_ALL_FIELDS)
+RESPONSE_FORMAT = _response_format("analysis", _ALL_FIELDS)
+
+# The realtime path splits the analysis into independent sub-analyses that run
+# in parallel, so the slowest field no longer gates the others.
+_CLINICAL_FIELDS = ("problems", "nudges", "follow_up")
+CLINICAL_PROMPT = _system_prompt(_CLINICAL_FIELDS)
+CLINICAL_FORMAT = _response_format("clinical", _CLINICAL_FIELDS)
+AFFECT_PROMPT = _system_prompt(("sentiment",))
+AFFECT_FORMAT = _response_format("affect", ("sentiment",))
+RISK_PROMPT = _system_prompt(("risk",))
+RISK_FORMAT = _response_format("risk", ("risk",))
+
+# Message dicts and templates are built once; each call only allocates the
+# per-turn instruction message.
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+_CLINICAL_MSG = {"role": "system", "content": CLINICAL_PROMPT}
+_AFFECT_MSG = {"role": "system", "content": AFFECT_PROMPT}
+_RISK_MSG = {"role": "system", "content": RISK_PROMPT}
+_PING_MESSAGES = [{"role": "user", "content": "ping"}]
+_ANALYSIS_INSTRUCTION = "Analyze the conversation so far."
+# Sent as system messages so the model never reads them as patient speech
+_ANALYSIS_MSG = {"role": "system", "content": _ANALYSIS_INSTRUCTION}
+_SPEAKER_ROLES = {"patient": "user", "counselor": "assistant"}
+_ROLE_SPEAKERS = {role: speaker for speaker, role in _SPEAKER_ROLES.items()}
+# Local classifiers only look at the tail of the conversation
+_CLASSIFIER_CHARS = 2048
+# Rough per-message overhead of the chat format, in tokens
+_MESSAGE_TOKENS = 3
+_SUMMARY_TEMPLATE = "Summary of earlier conversation:\n{summary}\n\n"
+_SUMMARY_MSG = {
+    "role": "system",
+    "content": "You summarize patient-counselor conversations. Given an existing summary and the turns that follow it, write one updated summary of at most 150 tokens that keeps the patient's problems, emotional state, risk indicators and what the counselor has already tried. Reply with the summary only.",
+}
+_PREVIOUS_NUDGES_TEMPLATE = (
+    "\n\nPrevious suggestions given to counselor:\n{nudges}"
+    "\n\nConsider these previous suggestions when providing new nudges. Build upon them or provide new relevant suggestions based on the current conversation state."
+)
+
+# One client per API key for the whole process, so every connection shares the
+# same keep-alive pool instead of paying a TLS handshake per websocket.
+_clients: Dict[str, AsyncOpenAI] = {}
+
+# Rate limits, timeouts, dropped connections and 5xx are worth retrying; anything
+# else (e.g. BadRequestError) fails fast.
+_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+_MAX_ATTEMPTS = 5
+
+
+def _get_client(api_key: str) -> AsyncOpenAI:
+    client = _clients.get(api_key)
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=api_key,
+            # Retries are handled by CounselorAgent._create_completion
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_keepalive_connections=64, max_connections=128)
+            ),
+        )
+        _clients[api_key] = client
+    return client
+
+
+class _JsonFieldScanner:
+    """Incrementally scans a streamed JSON object and emits each top-level field once complete."""
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key = None
+        self._expect_value = False
+        self._token_start = 0
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        self._buffer += text
+        fields = []
+        for i in range(self._pos, len(self._buffer)):
+            ch = self._buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        token = orjson.loads(self._buffer[self._token_start : i + 1])
+                        if self._expect_value:
+                            fields.append((self._key, token))
+                            self._expect_value = False
+                        else:
+                            self._key = token
+                continue
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._token_start = i
+            elif ch in "[{":
+                self._depth += 1
+                if self._depth == 2:
+                    self._token_start = i
+            elif ch in "]}":
+                self._depth -= 1
+                if self._depth == 1 and self._expect_value:
+                    fields.append(
+                        (
+                            self._key,
+                            orjson.loads(self._buffer[self._token_start : i + 1]),
+                        )
+                    )
+                    self._expect_value = False
+            elif ch == ":" and self._depth == 1:
+                self._expect_value = True
+        self._pos = len(self._buffer)
+        return fields
+
+
+def _normalize_field(key: str, value: Any) -> Any:
+    """Return a cleaned field value, or None if the model produced an unusable shape."""
+    if key in ("problems", "nudges", "sentiment") and not isinstance(value, list):
+        return None
+    if key == "sentiment":
+        return [word.lower().strip() for word in value]
+    if key == "follow_up" and not isinstance(value, str):
+        return None
+    if key == "risk" and value not in RESPONSE_SCHEMA["properties"]["risk"]["enum"]:
+        return None
+    return value
+
+
+def _normalize_result(result: Dict) -> Dict:
+    for key, default in (
+        ("problems", []),
+        ("nudges", []),
+        ("sentiment", ["neutral"]),
+        ("follow_up", ""),
+        ("risk", None),
+    ):
+        value = _normalize_field(key, result.get(key))
+        result[key] = value if value is not None else default
+    return result
+
+
+def turn_message(transcript: Dict[str, str]) -> Dict[str, str]:
+    """Map one transcript entry to a chat message: patient -> user, counselor -> assistant.
+
+    Malformed entries are coerced rather than rejected, so one bad turn from a
+    client cannot break every later sync of the session.
+    """
+    if not isinstance(transcript, dict):
+        transcript = {}
+    speaker = str(transcript.get("speaker") or "").lower()
+    return {
+        "role": _SPEAKER_ROLES.get(speaker, "user"),
+        "content": str(transcript.get("text") or ""),
+    }
+
+
+def format_messages(messages: List[Dict[str, str]]) -> str:
+    """Render chat messages back into ``speaker: text`` lines."""
+    return "\n".join(
+        f"{_ROLE_SPEAKERS.get(m['role'], m['role'])}: {m['content']}" for m in messages
+    )
+
+
+# Token counts only bound the prompt size, so one encoding serves every model
+_encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+
+
+class ConversationWindow:
+    """Per-connection conversation history capped at ``max_tokens`` prompt tokens.
+
+    Each turn is tokenized once when it arrives. Turns evicted from the left are
+    collected in ``evicted`` until they are folded into ``summary``.
+    """
+
+    def __init__(self, max_tokens: int = None):
+        self.max_tokens = max_tokens or int(os.getenv("MAX_HISTORY_TOKENS", "3500"))
+        self.turns: Deque[Tuple[int, Dict[str, str]]] = deque()
+        self.tokens = 0
+        # Characters of every turn seen, including evicted ones
+        self.chars = 0
+        self.evicted: List[Dict[str, str]] = []
+        self.summary = ""
+        self._offset = 0
+
+    def __len__(self) -> int:
+        return self._offset + len(self.turns)
+
+    def clear(self):
+        self.__init__(self.max_tokens)
+
+    def sync(self, transcripts: List[Dict[str, str]]) -> bool:
+        """Apply the client's full transcripts array; returns True if the window was reset.
+
+        Only turns from the last buffered one onward are re-processed, since ASR may
+        still revise the last turn.
+        """
+        reset = len(transcripts) < len(self)
+        if reset:
+            self.clear()
+        start = max(len(self) - 1, 0)
+        # Tokenize before touching the buffer so a failure leaves it unchanged
+        new_turns = []
+        for transcript in transcripts[start:]:
+            message = turn_message(transcript)
+            # encode_ordinary treats special-token text like <|endoftext|> as plain text
+            tokens = (
+                len(_encoding.encode_ordinary(message["content"])) + _MESSAGE_TOKENS
+            )
+            new_turns.append((tokens, message))
+        if self.turns:
+            tokens, message = self.turns.pop()
+            self.tokens -= tokens
+            self.chars -= len(message["content"])
+        for tokens, message in new_turns:
+            self.turns.append((tokens, message))
+            self.tokens += tokens
+            self.chars += len(message["content"])
+        # Always keep the latest turn, even if it alone exceeds the budget
+        while self.tokens > self.max_tokens and len(self.turns) > 1:
+            tokens, message = self.turns.popleft()
+            self.tokens -= tokens
+            self._offset += 1
+            self.evicted.append(message)
+        return reset
+
+    def messages(self) -> List[Dict[str, str]]:
+        return [message for _, message in self.turns]
+
 
 class CounselorAgent:
-    def __init__(self, api_key: Optional[str] = None, model: str = None):
+    # Per-turn nudges need low latency; offline reports can afford a larger model
+    realtime_model = "gpt-4o-mini"
+    batch_model = "gpt-4.1"
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model: str = None,
+        cache: Optional["SemanticCache"] = None,
+        sentiment_classifier: Optional["OnnxTextClassifier"] = None,
+        risk_classifier: Optional["OnnxTextClassifier"] = None,
+    ):
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError(
                 "OpenAI API key is required. Set OPENAI_API_KEY environment variable."
             )
-        self.client = OpenAI(api_key=self.api_key)
-        self.model = model or os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+        self.client = _get_client(self.api_key)
+        self.model = model or os.getenv("OPENAI_MODEL", self.realtime_model)
+        self.cache = cache
+        # Caps concurrent realtime OpenAI requests across every connection sharing
+        # this agent, so bursts queue here instead of tripping rate limits
+        self.llm_sem = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "32")))
+        # Pending background cache writes, referenced so they are not collected
+        self._cache_writes = set()
+        # When set, these fields are classified locally instead of by the LLM
+        self.sentiment_classifier = sentiment_classifier
+        self.risk_classifier = risk_classifier
 
-    def analyze_conversation(
-        self, transcripts: List[Dict[str, str]], previous_nudges: List[str] = None
+    async def analyze_conversation(
+        self,
+        conversation: List[Dict[str, str]],
+        previous_nudges: List[str] = None,
+        summary: str = "",
+        session_id: Optional[str] = None,
     ) -> Dict:
-        if not transcripts:
-            return {"problems": [], "nudges": [], "sentiment": ["neutral"]}
-        logger.info("Analyzing conversation with %d messages", len(transcripts))
+        analysis = {}
+        async for field, value in self.stream_analysis(
+            conversation, previous_nudges, summary, session_id
+        ):
+            if field is None:
+                analysis = value
+        return analysis
 
-        conversation_text = "\n".join(
-            [f"{msg.get('speaker')}: {msg.get('text')}" for msg in transcripts]
-        )
+    async def stream_analysis(
+        self,
+        conversation: List[Dict[str, str]],
+        previous_nudges: List[str] = None,
+        summary: str = "",
+        session_id: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[Optional[str], Any]]:
+        """Yield ``(field, value)`` as each field of the parallel sub-analyses completes.
 
-        previous_nudges_text = ""
-        if previous_nudges:
-            previous_nudges_text = (
-                "\n\nPrevious suggestions given to counselor:\n"
-                + "\n".join([f"- {nudge}" for nudge in previous_nudges])
-                + "\n\nConsider these previous suggestions when providing new nudges. Build upon them or provide new relevant suggestions based on the current conversation state."
+        ``conversation`` holds one chat message per turn (see ``turn_message``);
+        ``summary`` describes any earlier turns that were dropped from it.
+        ``session_id`` scopes near-duplicate cache matches to one session.
+        The last item is always ``(None, analysis)`` with the complete, normalized result.
+        """
+        if not conversation:
+            yield None, {
+                "problems": [],
+                "nudges": [],
+                "sentiment": ["neutral"],
+                "follow_up": "",
+                "risk": "low",
+            }
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Analyzing conversation with %d messages", len(conversation))
+
+        history = list(conversation)
+        if summary:
+            history.insert(
+                0,
+                {
+                    "role": "system",
+                    "content": _SUMMARY_TEMPLATE.format(summary=summary).rstrip(),
+                },
             )
+        # Only the final instruction differs between the sub-analyses
+        messages = history + [_ANALYSIS_MSG]
+        clinical_messages = messages
+        if previous_nudges:
+            clinical_messages = history + [
+                {
+                    "role": "system",
+                    "content": _ANALYSIS_INSTRUCTION
+                    + _PREVIOUS_NUDGES_TEMPLATE.format(
+                        nudges="\n".join(f"- {nudge}" for nudge in previous_nudges)
+                    ),
+                }
+            ]
 
-        prompt = f"""Analyze this patient-counselor conversation and provide:
+        cached = embedding = None
+        if self.cache:
+            key_text = orjson.dumps(
+                [summary, previous_nudges or [], conversation]
+            ).decode()
+            recent_text = format_messages(conversation[-3:])
+            # Embedding and sqlite work are blocking, so keep them off the event loop
+            try:
+                cached, embedding = await asyncio.to_thread(
+                    self.cache.lookup, key_text, recent_text, session_id
+                )
+            except Exception as e:
+                logger.error("Semantic cache lookup failed: %s", str(e), exc_info=True)
 
-            1. PROBLEMS: List all problems or concerns the patient is expressing. Each problem should be a short, clear statement. Return as a list.
+        # Cached entries never include risk, so it is always assessed fresh
+        subs = []
+        local_fields = []
+        if cached is None:
+            subs.append(self._analyze_clinical(clinical_messages))
+            if self.sentiment_classifier:
+                local_fields.append("sentiment")
+            else:
+                subs.append(self._analyze_affect(messages))
+        if self.risk_classifier:
+            local_fields.append("risk")
+        else:
+            subs.append(self._analyze_risk(messages))
+        queue = asyncio.Queue()
+        tasks = [asyncio.create_task(self._pump(sub, queue)) for sub in subs]
+        merged = {}
+        failure = None
+        try:
+            if cached is not None:
+                logger.debug("Semantic cache hit")
+                for field, value in cached.items():
+                    merged[field] = value
+                    yield field, value
+            # Classify locally while the LLM requests are in flight
+            if local_fields:
+                text = format_messages(conversation)[-_CLASSIFIER_CHARS:]
+                try:
+                    local = await asyncio.to_thread(
+                        self._classify_locally, text, local_fields
+                    )
+                except Exception as e:
+                    logger.error(
+                        "Error during local classification: %s", str(e), exc_info=True
+                    )
+                    local = {}
+                for field, value in local.items():
+                    value = _normalize_field(field, value)
+                    if value is not None:
+                        merged[field] = value
+                        yield field, value
+
+            pending = len(tasks)
+            while pending:
+                field, value = await queue.get()
+                if field is not None:
+                    yield field, value
+                    continue
+                pending -= 1
+                if isinstance(value, orjson.JSONDecodeError):
+                    # Only reachable if a reply was cut off (e.g. length limit or refusal)
+                    logger.error("Unable to analyze conversation - JSON parsing failed")
+                    failure = failure or "Unable to analyze"
+                elif isinstance(value, Exception):
+                    logger.error(
+                        "Error during conversation analysis: %s",
+                        str(value),
+                        exc_info=value,
+                    )
+                    failure = "Error occurred"
+                else:
+                    merged.update(value)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        clinical_failed = "problems" not in merged
+        result = _normalize_result(merged)
+        if clinical_failed:
+            result["problems"] = [failure]
+            result["nudges"] = (
+                ["Review conversation manually"]
+                if failure == "Unable to analyze"
+                else []
+            )
+        if self.cache and cached is None and failure is None:
+            # Written in the background so the result is not held up by sqlite
+            entry = {field: value for field, value in result.items() if field != "risk"}
+            task = asyncio.create_task(
+                self._store_cached(key_text, embedding, entry, session_id)
+            )
+            self._cache_writes.add(task)
+            task.add_done_callback(self._cache_writes.discard)
+        yield None, result
 
-            2. NUDGES: Provide 3-5 actionable suggestions for the counselor. Each nudge should be one short sentence. Return as a list.
+    async def _store_cached(self, key_text: str, embedding, entry: Dict, session_id):
+        try:
+            await asyncio.to_thread(
+                self.cache.store, key_text, embedding, entry, session_id
+            )
+        except Exception as e:
+            logger.error("Semantic cache store failed: %s", str(e), exc_info=True)
 
-            3. SENTIMENT: Identify the main emotional tone using simple words like: positive, negative, anxiety, neutral, sadness, anger, fear, hope, etc. Return as a list of 1-3 emotion words that best describe the conversation.
+    def _classify_locally(self, text: str, fields: List[str]) -> Dict:
+        results = {}
+        if "sentiment" in fields:
+            results["sentiment"] = [self.sentiment_classifier.classify(text)]
+        if "risk" in fields:
+            results["risk"] = self.risk_classifier.classify(text)
+        return results
 
-            Format your response as JSON with these exact keys:
-            {{
-            "problems": ["problem1", "problem2"],
-            "nudges": ["nudge1", "nudge2", "nudge3"],
-            "sentiment": ["word1", "word2"]
-            }}
+    def end_session(self, session_id: str):
+        """Release per-session cache state once a connection closes."""
+        if self.cache:
+            self.cache.end_session(session_id)
 
-            Use simple, clear words. Keep everything short and direct.
+    async def warmup(self, timeout: float = 5.0):
+        """Send a one-token request so the TLS connection and model routing are warm.
 
-            Conversation:
-            {conversation_text}{previous_nudges_text}
-            """
+        ``timeout`` replaces the SDK's 600s default, so a stalled response fails fast.
+        """
+        await self.client.chat.completions.create(
+            model=self.model, messages=_PING_MESSAGES, max_tokens=1, timeout=timeout
+        )
 
+    async def summarize(self, summary: str, turns: List[Dict[str, str]]) -> str:
+        """Fold ``turns`` into the running ``summary``; returns the old one on failure."""
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are an expert counselor assistant. You MUST respond ONLY with valid JSON. No explanations, no markdown, just pure JSON.",
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.7,
-                response_format={"type": "json_object"},
-            )
+            async with self.llm_sem:
+                response = await self._create_completion(
+                    model=self.model,
+                    messages=[
+                        _SUMMARY_MSG,
+                        {
+                            "role": "user",
+                            "content": _SUMMARY_TEMPLATE.format(
+                                summary=summary or "(none)"
+                            )
+                            + format_messages(turns),
+                        },
+                    ],
+                    temperature=0,
+                    max_tokens=200,
+                )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.error("Error summarizing conversation: %s", str(e), exc_info=True)
+            return summary
 
-            result_text = response.choices[0].message.content.strip()
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0].strip()
-            result = json.loads(result_text)
-
-            if "problems" not in result or not isinstance(result["problems"], list):
-                result["problems"] = []
-            if "nudges" not in result or not isinstance(result["nudges"], list):
-                result["nudges"] = []
-            if "sentiment" not in result or not isinstance(result["sentiment"], list):
-                result["sentiment"] = ["neutral"]
-            if result["sentiment"]:
-                result["sentiment"] = [
-                    word.lower().strip() for word in result["sentiment"]
-                ]
-
-            return result
-        except json.JSONDecodeError:
-            logger.warning(
-                "Failed to parse JSON response, attempting fallback extraction"
-            )
+    async def _create_completion(self, **kwargs):
+        """``chat.completions.create`` with jittered exponential backoff on transient errors.
+
+        A ``Retry-After`` header from OpenAI takes precedence over the computed delay.
+        """
+        for attempt in range(_MAX_ATTEMPTS):
             try:
-                json_match = re.search(
-                    r"\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}", result_text, re.DOTALL
+                return await self.client.chat.completions.create(**kwargs)
+            except _RETRYABLE_ERRORS as e:
+                if attempt == _MAX_ATTEMPTS - 1:
+                    raise
+                delay = min(2**attempt, 30) + random.random()
+                response = getattr(e, "response", None)
+                retry_after = (
+                    response.headers.get("retry-after")
+                    if response is not None
+                    else None
                 )
-                if json_match:
-                    result = json.loads(json_match.group())
-                    if "problems" not in result or not isinstance(
-                        result["problems"], list
-                    ):
-                        result["problems"] = []
-                    if "nudges" not in result or not isinstance(result["nudges"], list):
-                        result["nudges"] = []
-                    if "sentiment" not in result or not isinstance(
-                        result["sentiment"], list
-                    ):
-                        result["sentiment"] = ["neutral"]
-                    return result
-            except (json.JSONDecodeError, ValueError, AttributeError):
-                logger.error("Failed to extract JSON from response", exc_info=True)
-            logger.error("Unable to analyze conversation - JSON parsing failed")
-            return {
-                "problems": ["Unable to analyze"],
-                "nudges": ["Review conversation manually"],
-                "sentiment": ["neutral"],
-            }
+                if retry_after:
+                    try:
+                        delay = float(retry_after)
+                    except ValueError:
+                        pass
+                logger.warning(
+                    "OpenAI request failed (%s), retrying in %.1fs (attempt %d/%d)",
+                    type(e).__name__,
+                    delay,
+                    attempt + 1,
+                    _MAX_ATTEMPTS,
+                )
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _pump(sub: AsyncIterator[Tuple[Optional[str], Any]], queue):
+        """Forward a sub-analysis into the shared queue, ending with ``(None, result)``.
+
+        The result is the sub-analysis fields, or the exception that stopped it.
+        """
+        try:
+            async for item in sub:
+                await queue.put(item)
         except Exception as e:
-            logger.error(
-                "Error during conversation analysis: %s", str(e), exc_info=True
+            await queue.put((None, e))
+
+    async def _analyze_clinical(self, messages: List[Dict[str, str]]):
+        async for item in self._stream_fields(_CLINICAL_MSG, CLINICAL_FORMAT, messages):
+            yield item
+
+    async def _analyze_affect(self, messages: List[Dict[str, str]]):
+        async for item in self._stream_fields(_AFFECT_MSG, AFFECT_FORMAT, messages):
+            yield item
+
+    async def _analyze_risk(self, messages: List[Dict[str, str]]):
+        async for item in self._stream_fields(_RISK_MSG, RISK_FORMAT, messages):
+            yield item
+
+    async def _stream_fields(
+        self,
+        system_message: Dict,
+        response_format: Dict,
+        messages: List[Dict[str, str]],
+    ) -> AsyncIterator[Tuple[Optional[str], Any]]:
+        """Stream one structured completion, yielding fields as they complete.
+
+        Ends with ``(None, fields)``; errors propagate to the caller. The slot is
+        held until the stream is drained, which never waits on the websocket since
+        ``_pump`` forwards into an unbounded queue.
+        """
+        chunks = []
+        scanner = _JsonFieldScanner()
+        async with self.llm_sem:
+            stream = await self._create_completion(
+                model=self.model,
+                messages=[system_message, *messages],
+                temperature=0,
+                response_format=response_format,
+                stream=True,
             )
-            return {
-                "problems": ["Error occurred"],
-                "nudges": [],
-                "sentiment": ["neutral"],
-            }
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = chunk.choices[0].delta.content
+                chunks.append(delta)
+                for field, value in scanner.feed(delta):
+                    value = _normalize_field(field, value)
+                    if value is not None:
+                        yield field, value
+        yield None, orjson.loads("".join(chunks))
+
+    async def analyze_session_offline(
+        self, session_id: str, conversation: List[Dict[str, str]]
+    ) -> str:
+        """Submit a full session for analysis through the Batch API (50% cheaper, up to 24h).
+
+        Returns the batch id; pass it to ``collect_offline_results`` to fetch the analysis.
+        """
+        request = {
+            "custom_id": session_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.batch_model,
+                "messages": [_SYSTEM_MSG, *conversation, _ANALYSIS_MSG],
+                "temperature": 0,
+                "response_format": RESPONSE_FORMAT,
+            },
+        }
+        batch_file = await self.client.files.create(
+            file=(f"{session_id}.jsonl", orjson.dumps(request) + b"\n"),
+            purpose="batch",
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        logger.info("Submitted session %s as batch %s", session_id, batch.id)
+        return batch.id
+
+    async def collect_offline_results(
+        self, batch_id: str, output_dir: str = None, poll_interval: float = 60.0
+    ) -> Dict[str, Dict]:
+        """Poll a batch until it finishes and store each session's analysis as JSON.
+
+        Intended to run as a background task; returns analyses keyed by session id.
+        """
+        output_dir = output_dir or os.getenv("BATCH_RESULTS_DIR", "batch_results")
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+            if batch.status == "completed":
+                break
+            if batch.status in ("failed", "expired", "cancelled"):
+                raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+            await asyncio.sleep(poll_interval)
+
+        results = {}
+        if not batch.output_file_id:
+            logger.error("Batch %s completed without any successful results", batch_id)
+            return results
+        content = await self.client.files.content(batch.output_file_id)
+        os.makedirs(output_dir, exist_ok=True)
+        for line in content.text.splitlines():
+            if not line:
+                continue
+            record = orjson.loads(line)
+            session_id = record["custom_id"]
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                logger.error(
+                    "Offline analysis failed for session %s: %s",
+                    session_id,
+                    record.get("error"),
+                )
+                continue
+            reply = response["body"]["choices"][0]["message"]["content"]
+            results[session_id] = _normalize_result(orjson.loads(reply))
+            with open(os.path.join(output_dir, f"{session_id}.json"), "wb") as f:
+                f.write(orjson.dumps(results[session_id]))
+        logger.info("Stored %d offline analyses from batch %s", len(results), batch_id)
+        return results
@@ -3,9 +3,9 @@ Example WebSocket Client for Counselor Agent
 """
 
 import asyncio
-import json
 import os
 from dotenv import load_dotenv
+import msgpack
 import websockets
 
 load_dotenv()
@@ -42,7 +42,7 @@ async def test_counselor_agent():
     try:
         async with websockets.connect(uri) as websocket:
             print("Connected to Counselor Agent WebSocket Server\n")
-            await websocket.recv()  # Welcome message
+            await websocket.recv()  # Welcome message (always a JSON text frame)
 
             for i in range(len(transcripts)):
                 current_transcripts = transcripts[: i + 1]
@@ -52,11 +52,16 @@ async def test_counselor_agent():
                 print(f"  {last_transcript['text']}")
 
                 message = {"type": "transcript", "transcripts": current_transcripts}
-                await websocket.send(json.dumps(message))
-                response = await websocket.recv()
-                data = json.loads(response)
+                # Binary msgpack frames; the server replies in kind
+                await websocket.send(msgpack.packb(message, use_bin_type=True))
+                # Patient messages stream partial fields before the complete analysis
+                while True:
+                    data = msgpack.unpackb(await websocket.recv(), raw=False)
+                    if data.get("type") != "analysis_partial":
+                        break
+                    print(f"  ... received {data.get('field')}")
 
-                if data.get("type") == "analysis":
+                if data.get("type") == "analysis_complete":
                     print("\n" + "=" * 60)
                     print("ANALYSIS RESULTS:")
                     print("=" * 60)
@@ -68,9 +73,15 @@ async def test_counselor_agent():
                         print(f"  - {nudge}")
                     print("\nSENTIMENT:")
                     print(f"  {', '.join(data.get('sentiment', ['neutral']))}")
+                    print("\nFOLLOW-UP:")
+                    print(f"  {data.get('follow_up', '')}")
+                    print("\nRISK:")
+                    print(f"  {data.get('risk')}")
                     print("=" * 60)
                 elif data.get("type") == "acknowledged":
                     print(f"✓ {data.get('message', 'Received')}")
+                elif data.get("type") == "error":
+                    print(f"✗ {data.get('message', 'Error')}")
 
     except (ConnectionRefusedError, OSError):
         print("Error: Could not connect to server.")
@@ -0,0 +1,116 @@
+"""
+Semantic Cache - Reuses analyses for repeated or near-duplicate conversation states
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """Two-level cache of analysis results backed by sqlite.
+
+    Lookups first try an exact match on a hash of the full analysis input, then a
+    cosine-similarity match on an embedding of the most recent turns. Similarity
+    matches only consider entries from the same session and are kept in memory;
+    exact matches are persisted and shared across sessions.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        model_name: Optional[str] = None,
+        threshold: Optional[float] = None,
+    ):
+        # Imported here so torch is only loaded when the cache is enabled
+        from sentence_transformers import SentenceTransformer
+
+        self.path = path or os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.db")
+        self.threshold = (
+            threshold
+            if threshold is not None
+            else float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+        )
+        self.encoder = SentenceTransformer(
+            model_name or os.getenv("SEMANTIC_CACHE_MODEL", "all-MiniLM-L6-v2")
+        )
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL)"
+        )
+        rows = self._db.execute("SELECT key, result FROM results").fetchall()
+        self._exact: Dict[str, Dict] = {
+            key: orjson.loads(result) for key, result in rows
+        }
+        # Per-session embedding matrix whose rows line up with the result list
+        self._sessions: Dict[str, Tuple[np.ndarray, List[Dict]]] = {}
+        logger.info("Semantic cache loaded %d entries from %s", len(rows), self.path)
+
+    @staticmethod
+    def _key(key_text: str) -> str:
+        return hashlib.blake2b(key_text.encode("utf-8")).hexdigest()
+
+    def lookup(
+        self, key_text: str, recent_text: str, session_id: Optional[str] = None
+    ) -> Tuple[Optional[Dict], Optional[np.ndarray]]:
+        """Return ``(result, embedding)``; result is None on a miss.
+
+        ``key_text`` must cover everything the analysis depends on. The embedding of
+        ``recent_text`` is only computed when ``session_id`` is given, and is returned
+        so a miss can be stored without encoding it twice.
+        """
+        result = self._exact.get(self._key(key_text))
+        if result is not None or session_id is None:
+            return result, None
+
+        embedding = self.encoder.encode(
+            recent_text, normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+        with self._lock:
+            matrix, results = self._sessions.get(session_id, (None, []))
+            if results:
+                scores = matrix @ embedding
+                best = int(np.argmax(scores))
+                if scores[best] > self.threshold:
+                    return results[best], embedding
+        return None, embedding
+
+    def store(
+        self,
+        key_text: str,
+        embedding: Optional[np.ndarray],
+        result: Dict,
+        session_id: Optional[str] = None,
+    ):
+        key = self._key(key_text)
+        with self._lock:
+            if session_id is not None and embedding is not None:
+                matrix, results = self._sessions.get(
+                    session_id, (np.empty((0, len(embedding)), np.float32), [])
+                )
+                results.append(result)
+                self._sessions[session_id] = (np.vstack([matrix, embedding]), results)
+            if key in self._exact:
+                return
+            # Another process sharing the file may already have written this key
+            self._db.execute(
+                "INSERT OR IGNORE INTO results (key, result) VALUES (?, ?)",
+                (key, orjson.dumps(result).decode()),
+            )
+            self._db.commit()
+            self._exact[key] = result
+
+    def end_session(self, session_id: str):
+        """Drop a finished session's similarity entries."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
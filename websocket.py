@@ -4,56 +4,208 @@ Receives transcripts and sends real-time analysis (problems, nudges, sentiment)
 """
 
 import asyncio
-import json
+import atexit
+import contextlib
 import logging
+import logging.handlers
+import queue
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
 import os
+import msgpack
+import orjson
 from aiohttp import web
 from dotenv import load_dotenv
-from counselor_agent import CounselorAgent
+from classifiers import RISK_LABELS, SENTIMENT_LABELS, load_classifier
+from counselor_agent import ConversationWindow, CounselorAgent
+from semantic_cache import SemanticCache
 import websockets
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
+# Configure logging; records are handed to a listener thread so stream writes
+# never block the event loop
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+)
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+# The listener's handler applies the real format; the queue side passes messages as-is
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
+    format="%(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
 )
 logger = logging.getLogger(__name__)
 
 
+def _encode(payload: dict, binary: bool = False):
+    if binary:
+        return msgpack.packb(payload, use_bin_type=True)
+    # Decoded so frames stay text for JSON.parse-based clients
+    return orjson.dumps(payload).decode()
+
+
+def _decode(message) -> dict:
+    """Parse a frame: binary frames are msgpack, text frames are JSON.
+
+    Raises ValueError for anything that is not a single encoded object.
+    """
+    if isinstance(message, bytes):
+        data = msgpack.unpackb(message, raw=False)
+    else:
+        data = orjson.loads(message)
+    if not isinstance(data, dict):
+        raise ValueError("Message must be an object")
+    return data
+
+
+@dataclass
+class SessionState:
+    """Per-connection state; the agent itself is shared by every connection."""
+
+    session_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    previous_nudges: List[str] = field(default_factory=list)
+    conversation: ConversationWindow = field(default_factory=ConversationWindow)
+    # Conversation size (turns, characters) when the last analysis started
+    analyzed_state: Tuple[int, int] = (0, 0)
+    pending_task: Optional[asyncio.Task] = None
+    summary_task: Optional[asyncio.Task] = None
+    # Set once the client sends a binary frame or a hello with binary=true
+    binary: bool = False
+
+
 class CounselorWebSocketServer:
     """WebSocket server for real-time counselor agent analysis."""
 
-    def __init__(self, api_key: str = None, model: str = "gpt-3.5-turbo"):
+    def __init__(self, api_key: str = None, model: str = None):
         self.api_key = api_key
-        self.model = model
+        # Shared by every connection; per-connection state lives in SessionState
+        cache = None
+        if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true":
+            cache = SemanticCache()
+        self.agent = CounselorAgent(
+            api_key=api_key,
+            model=model,
+            cache=cache,
+            sentiment_classifier=load_classifier("SENTIMENT", SENTIMENT_LABELS),
+            risk_classifier=load_classifier("RISK", RISK_LABELS),
+        )
+        self.model = self.agent.model
+        self.debounce_seconds = float(os.getenv("ANALYSIS_DEBOUNCE_SECONDS", "0.4"))
+        self.min_new_chars = int(os.getenv("ANALYSIS_MIN_NEW_CHARS", "10"))
         self.active_connections = 0
         self.total_connections = 0
+        self.warmup_ttl = float(os.getenv("WARMUP_TTL_SECONDS", "60"))
+        self.warmup_timeout = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "5"))
+        self._last_warmup = None
+        self._warmup_task = None
 
     async def handle_client(self, websocket):
-        # Each connection gets its own agent and stores previous nudges
-        agent = CounselorAgent(api_key=self.api_key, model=self.model)
-        previous_nudges = []
+        session = SessionState()
+
+        async def send(payload: dict):
+            await websocket.send(_encode(payload, session.binary))
+
+        async def summarize_evicted():
+            # Fold turns that fell out of the token window into the running summary
+            while session.conversation.evicted:
+                turns, session.conversation.evicted = session.conversation.evicted, []
+                session.conversation.summary = await self.agent.summarize(
+                    session.conversation.summary, turns
+                )
+
+        async def delayed_analyze():
+            # Let a burst of patient messages (e.g. ASR partials) settle into one call
+            await asyncio.sleep(self.debounce_seconds)
+            started_state = (len(session.conversation), session.conversation.chars)
+            # From here on the client always gets a closing message
+            try:
+                analysis = {}
+                async for name, value in self.agent.stream_analysis(
+                    session.conversation.messages(),
+                    previous_nudges=session.previous_nudges,
+                    summary=session.conversation.summary,
+                    session_id=session.session_id,
+                ):
+                    if name is None:
+                        analysis = value
+                        continue
+                    await send(
+                        {"type": "analysis_partial", "field": name, "value": value}
+                    )
+                session.previous_nudges = analysis.get("nudges", [])
+                session.analyzed_state = started_state
+
+                logger.info(
+                    "Analysis completed for patient message from %s",
+                    websocket.remote_address,
+                )
+                await send(
+                    {
+                        "type": "analysis_complete",
+                        "problems": analysis.get("problems", []),
+                        "nudges": analysis.get("nudges", []),
+                        "sentiment": analysis.get("sentiment", ["neutral"]),
+                        "follow_up": analysis.get("follow_up", ""),
+                        "risk": analysis.get("risk"),
+                    }
+                )
+            except websockets.exceptions.ConnectionClosed:
+                logger.debug(
+                    "Client %s closed before analysis was sent",
+                    websocket.remote_address,
+                )
+            except asyncio.CancelledError:
+                # Superseded by a newer patient message (or the connection closed)
+                with contextlib.suppress(websockets.exceptions.ConnectionClosed):
+                    await send(
+                        {
+                            "type": "analysis_cancelled",
+                            "message": "Superseded by a newer message",
+                        }
+                    )
+                raise
+            except Exception as e:
+                logger.error(
+                    "Error analyzing conversation for %s: %s",
+                    websocket.remote_address,
+                    str(e),
+                    exc_info=True,
+                )
+                with contextlib.suppress(websockets.exceptions.ConnectionClosed):
+                    await send({"type": "error", "message": "Analysis failed"})
+
         self.active_connections += 1
         self.total_connections += 1
         logger.info("Client connected: %s", websocket.remote_address)
         try:
-            await websocket.send(
-                json.dumps(
-                    {
-                        "type": "connected",
-                        "message": "Connected to Counselor Agent. Send full transcripts array to get analysis.",
-                    }
-                )
+            await send(
+                {
+                    "type": "connected",
+                    "message": "Connected to Counselor Agent. Send full transcripts array to get analysis.",
+                }
             )
 
             async for message in websocket:
                 try:
-                    data = json.loads(message)
-                    if data.get("type") == "transcript":
+                    data = _decode(message)
+                    if isinstance(message, bytes):
+                        session.binary = True
+                    if data.get("type") == "hello":
+                        session.binary = bool(data.get("binary", session.binary))
+                        await send({"type": "hello", "binary": session.binary})
+                    elif data.get("type") == "transcript":
                         transcripts = data.get("transcripts", [])
 
                         # Validate and get last transcript
@@ -73,60 +225,68 @@ class CounselorWebSocketServer:
                             speaker,
                         )
 
-                        # Patient -> analyze, Counselor -> acknowledge
-                        if speaker == "patient":
-                            analysis = agent.analyze_conversation(
-                                transcripts, previous_nudges=previous_nudges
+                        # Clients resend the full array; the window only processes
+                        # turns it has not seen (plus the last one, which ASR may revise)
+                        if session.conversation.sync(transcripts):
+                            session.analyzed_state = (0, 0)
+                            if session.summary_task:
+                                session.summary_task.cancel()
+                                # Cancellation is not immediate; let a new task start
+                                session.summary_task = None
+                        if session.conversation.evicted and (
+                            session.summary_task is None or session.summary_task.done()
+                        ):
+                            session.summary_task = asyncio.create_task(
+                                summarize_evicted()
                             )
-                            previous_nudges = analysis.get("nudges", [])
 
-                            logger.info(
-                                "Analysis completed for patient message from %s",
-                                websocket.remote_address,
-                            )
-                            await websocket.send(
-                                json.dumps(
+                        # Patient -> analyze, Counselor -> acknowledge
+                        if speaker == "patient":
+                            # Revisions of an already analyzed turn need enough new text
+                            analyzed_turns, analyzed_chars = session.analyzed_state
+                            if (
+                                len(session.conversation) == analyzed_turns
+                                and abs(session.conversation.chars - analyzed_chars)
+                                < self.min_new_chars
+                            ):
+                                await send(
                                     {
-                                        "type": "analysis",
-                                        "problems": analysis.get("problems", []),
-                                        "nudges": analysis.get("nudges", []),
-                                        "sentiment": analysis.get(
-                                            "sentiment", ["neutral"]
-                                        ),
+                                        "type": "acknowledged",
+                                        "message": "No new content to analyze",
                                     }
                                 )
+                                continue
+                            # A newer patient message supersedes any pending analysis
+                            if session.pending_task and not session.pending_task.done():
+                                session.pending_task.cancel()
+                            session.pending_task = asyncio.create_task(
+                                delayed_analyze()
                             )
                         else:
                             # Counselor message, just acknowledge
-                            await websocket.send(
-                                json.dumps(
-                                    {
-                                        "type": "acknowledged",
-                                        "message": "Transcript received",
-                                    }
-                                )
+                            await send(
+                                {
+                                    "type": "acknowledged",
+                                    "message": "Transcript received",
+                                }
                             )
 
                     elif data.get("type") == "ping":
-                        await websocket.send(
-                            json.dumps({"type": "pong", "message": "alive"})
-                        )
+                        await send({"type": "pong", "message": "alive"})
                     else:
-                        await websocket.send(
-                            json.dumps(
-                                {
-                                    "type": "error",
-                                    "message": f"Unknown message type: {data.get('type')}",
-                                }
-                            )
+                        await send(
+                            {
+                                "type": "error",
+                                "message": f"Unknown message type: {data.get('type')}",
+                            }
                         )
-                except json.JSONDecodeError:
+                # Covers orjson.JSONDecodeError and every msgpack decode error,
+                # including extra data and truncated input
+                except ValueError:
                     logger.warning(
-                        "Invalid JSON received from %s", websocket.remote_address
-                    )
-                    await websocket.send(
-                        json.dumps({"type": "error", "message": "Invalid JSON format"})
+                        "Invalid message received from %s", websocket.remote_address
                     )
+                    await send({"type": "error", "message": "Invalid message format"})
                 except Exception as e:
                     logger.error(
                         "Error processing message from %s: %s",
@@ -134,9 +294,7 @@ class CounselorWebSocketServer:
                         str(e),
                         exc_info=True,
                     )
-                    await websocket.send(
-                        json.dumps({"type": "error", "message": f"Error: {str(e)}"})
-                    )
+                    await send({"type": "error", "message": f"Error: {str(e)}"})
 
         except websockets.exceptions.ConnectionClosed:
             logger.info("Client disconnected: %s", websocket.remote_address)
@@ -148,9 +306,31 @@ class CounselorWebSocketServer:
                 exc_info=True,
             )
         finally:
+            for task in (session.pending_task, session.summary_task):
+                if task:
+                    task.cancel()
+            self.agent.end_session(session.session_id)
             self.active_connections = max(0, self.active_connections - 1)
             logger.info("Connection closed: %s", websocket.remote_address)
 
+    async def _warmup(self):
+        # Concurrent probes share one in-flight request; shielded so a caller that
+        # goes away does not cancel it for the others
+        if self._warmup_task is None or self._warmup_task.done():
+            self._warmup_task = asyncio.create_task(self._run_warmup())
+        await asyncio.shield(self._warmup_task)
+
+    async def _run_warmup(self):
+        await self.agent.warmup(timeout=self.warmup_timeout)
+        self._last_warmup = time.monotonic()
+
+    async def _initial_warmup(self):
+        try:
+            await self._warmup()
+            logger.info("OpenAI connection warmed up")
+        except Exception as e:
+            logger.warning("OpenAI warmup failed: %s", str(e))
+
     async def health_check(self, _request):
         """Health check endpoint."""
         return web.json_response(
@@ -173,7 +353,12 @@ class CounselorWebSocketServer:
                     },
                     status=503,
                 )
-            CounselorAgent(api_key=self.api_key, model=self.model)
+            # A real round trip, cached so probes don't add steady OpenAI traffic
+            if (
+                self._last_warmup is None
+                or time.monotonic() - self._last_warmup > self.warmup_ttl
+            ):
+                await self._warmup()
             return web.json_response(
                 {
                     "status": "ready",
@@ -220,6 +405,10 @@ class CounselorWebSocketServer:
             "Health check endpoints available at http://%s:%s/health", host, health_port
         )
 
+        # Open the OpenAI connection before the first patient message needs it,
+        # without holding the websocket port closed while it runs
+        self._startup_warmup = asyncio.create_task(self._initial_warmup())
+
         # Start WebSocket server
         logger.info("Starting WebSocket server on ws://%s:%s", host, port)
         async with websockets.serve(self.handle_client, host, port):
@@ -227,11 +416,15 @@ class CounselorWebSocketServer:
 
 
 async def main():
+    # Bounds how many blocking jobs (cache embeddings/sqlite) run at once
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=int(os.getenv("THREAD_POOL_WORKERS", "64")))
+    )
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         logger.error("OPENAI_API_KEY not found in environment variables")
         return
-    model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+    model = os.getenv("OPENAI_MODEL", CounselorAgent.realtime_model)
     server = CounselorWebSocketServer(api_key=api_key, model=model)
     await server.start_server()
 